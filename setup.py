@@ -49,5 +49,6 @@ setup(name="pytroll-active-fire-runner",
       data_files=[],
       zip_safe=False,
       install_requires=['posttroll'],
+      python_requires='>=3.9',
       use_scm_version=True,
       )
@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 - 2023 Pytroll
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Processing of VIIRS SDRs to Active Fire outputs with CSPP.
+
+The posttroll messages on new VIIRS SDRs are turned into CSPP VIIRS Active Fire runs
+in a pool of worker processes, and the results are delivered and published.
+"""
+
+import logging
+import logging.handlers
+import multiprocessing
+import operator
+import os
+import queue
+import selectors
+import shlex
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count
+from subprocess import Popen, PIPE, DEVNULL, run
+from urllib.parse import urlparse
+
+import posttroll.subscriber
+from posttroll.publisher import Publish
+from posttroll.message import Message
+
+from viirs_active_fires.utils import (deliver_output_files, cleanup_cspp_workdir,
+                                      get_edr_times, get_active_fire_result_files)
+
+ptimer = time.perf_counter
+
+CSPP_AF_HOME = os.environ.get("CSPP_ACTIVE_FIRE_HOME", '')
+CSPP_AF_WORKDIR = os.environ.get("CSPP_ACTIVE_FIRE_WORKDIR", '')
+
+VIIRS_SATELLITES = ['Suomi-NPP', 'NOAA-20', 'NOAA-21', 'NOAA-22']
+_VIIRS_SATS_SET = frozenset(VIIRS_SATELLITES)
+
+#: Seconds without new messages that end a burst of messages
+BURST_TIMEOUT = 0.05
+
+#: Shortest timeout in seconds when waiting for a message
+MIN_RECV_TIMEOUT = 0.001
+
+LOG = logging.getLogger('viirs-active-fire-runner')
+
+_get_uri = operator.itemgetter('uri')
+
+
+class ViirsActiveFiresProcessor(object):
+    """Container for the VIIRS Active Fires processing based on CSPP."""
+
+    def __init__(self, ncpus, options):
+        """Initialize the VIIRS Active Fires Processing instance."""
+        # Spawn the workers instead of forking this process, which already runs the posttroll threads.
+        # Their log records are sent back here, as spawned workers don't share our logging setup.
+        mp_context = multiprocessing.get_context('spawn')
+        self._log_queue = mp_context.Queue()
+        self._log_listener = logging.handlers.QueueListener(self._log_queue, _LogRecordForwarder())
+        self._log_listener.start()
+        self.pool = ProcessPoolExecutor(max_workers=ncpus, mp_context=mp_context,
+                                        initializer=_init_worker_logging,
+                                        initargs=(self._log_queue, LOG.getEffectiveLevel()))
+        self.ncpus = ncpus
+        # Bound the number of CSPP runs queued or running, so bursts of messages can't pile up
+        self.max_inflight = 2 * ncpus
+        self._inflight = threading.BoundedSemaphore(self.max_inflight)
+        self._all_workdirs = [make_cspp_workdir(prefix='worker_%d_' % idx) for idx in range(self.max_inflight)]
+        self.workdirs = queue.Queue()
+        for working_dir in self._all_workdirs:
+            self.workdirs.put(working_dir)
+
+        self.orbit_number = 1  # Initialised orbit number
+        self.platform_name = 'unknown'  # Ex.: Suomi-NPP
+        self.cspp_results = queue.SimpleQueue()
+        self.pass_start_time = None
+        self.result_files = []
+        self.sdr_files = []
+        self.result_home = options.get('output_dir', '/tmp')
+        self.publish_topic = options.get('publish_topic')
+        self.site = options.get('site', 'unknown')
+        self.environment = options.get('environment')
+        self.message_data = None
+        self.service = None
+        self.batch_window = float(options.get('batch_window', 0))
+        self.cspp_base_cmdlist = get_cspp_base_cmdlist(options)
+        self._pending_sdr_files = []
+        self._pending_message_data = None
+        self._batch_deadline = None
+        self._batch_key = None
+
+    @property
+    def recv_timeout(self):
+        """Get the timeout for receiving the next message, so a pending batch gets submitted when it is due."""
+        if not self._pending_sdr_files:
+            return None
+        # posttroll takes a zero timeout as no timeout at all
+        return max(self._batch_deadline - time.monotonic(), MIN_RECV_TIMEOUT)
+
+    def initialise(self, service):
+        """Initialise the processor."""
+        self.cspp_results = queue.SimpleQueue()
+        self.pass_start_time = None
+        self.result_files = []
+        self.sdr_files = []
+        self.service = service
+
+    def get_cspp_futures(self):
+        """Get the futures of all CSPP runs submitted since the last call, with the message data of each."""
+        futures = {}
+        while not self.cspp_results.empty():
+            future, message_data = self.cspp_results.get_nowait()
+            futures[future] = message_data
+        return futures
+
+    def deliver_output_files(self, subd=None):
+        """Deliver the output files."""
+        LOG.debug("Result files: %s", self.result_files)
+        LOG.debug("Result home dir: %s", self.result_home)
+        LOG.debug("Sub directory: %s", subd)
+        return deliver_output_files(self.result_files, self.result_home, subd)
+
+    def run(self, msg):
+        """Take in one message, and start the VIIRS Active Fires processing using CSPP when due.
+
+        Return False when a CSPP run has been submitted, so its results can be collected.
+        """
+        nruns = self.cspp_results.qsize()
+        # Check the batch deadline on every call, also on timeouts and on messages that are filtered out
+        self.submit_batch_if_due()
+        if msg:
+            self._add_message(msg)
+
+        if self.cspp_results.qsize() == nruns:
+            return True
+
+        LOG.debug("Inside run: Return with a False...")
+        return False
+
+    def _add_message(self, msg):
+        """Add the SDR files of the message to the pending batch, if it is a supported VIIRS dataset."""
+        LOG.debug("Received message: %s", msg)
+
+        if 'platform_name' not in msg.data or 'sensor' not in msg.data:
+            LOG.debug("No platform_name or sensor in message. Continue...")
+            return
+        if msg.data['platform_name'] not in _VIIRS_SATS_SET or msg.data['sensor'] != 'viirs':
+            LOG.info("Not a supported VIIRS scene. Satellite = %s - Continue...",
+                     msg.data['platform_name'])
+            return
+
+        if msg.type != 'dataset':
+            LOG.info("Not a dataset, don't do anything...")
+            return
+
+        self.platform_name = str(msg.data['platform_name'])
+        self.sensor = str(msg.data['sensor'])
+        self.message_data = msg.data
+
+        sdr_dataset = msg.data['dataset']
+        if len(sdr_dataset) < 1:
+            return
+
+        # Assume all files are valid sdr files ending with '.h5'
+        sdr_files = list(map(uri_to_path, map(_get_uri, sdr_dataset)))
+
+        # The granules of one batch are published together, so they must be from the same platform and orbit
+        batch_key = (msg.data['platform_name'], msg.data.get('orbit_number'))
+        if self._pending_sdr_files and batch_key != self._batch_key:
+            self.submit_batch()
+
+        if not self._pending_sdr_files:
+            self._batch_deadline = time.monotonic() + self.batch_window
+            self._batch_key = batch_key
+            self._pending_message_data = msg.data
+        self._pending_sdr_files.extend(sdr_files)
+
+        if not self.submit_batch_if_due():
+            LOG.debug("Wait for more SDR granules before running CSPP...")
+
+    def submit_batch_if_due(self):
+        """Submit one CSPP run on all pending SDR files when the batch window has passed.
+
+        Return True if a CSPP run was submitted.
+        """
+        if not self._pending_sdr_files or time.monotonic() < self._batch_deadline:
+            return False
+
+        self.submit_batch()
+        return True
+
+    def submit_batch(self):
+        """Submit one CSPP run on all pending SDR files."""
+        self.sdr_files = self._pending_sdr_files
+        self._pending_sdr_files = []
+        self._inflight.acquire()
+        working_dir = self.workdirs.get()
+        future = self.pool.submit(spawn_cspp, self.sdr_files, self.service,
+                                  self.cspp_base_cmdlist, working_dir)
+        future.add_done_callback(lambda _: self._inflight.release())
+        self.cspp_results.put((future, self._pending_message_data))
+
+    def shutdown(self):
+        """Wait for the running CSPP runs to finish, stop the worker processes and remove the working dirs.
+
+        CSPP runs that have not started yet are cancelled, as nobody would deliver their results.
+        """
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        self._log_listener.stop()
+        for working_dir in self._all_workdirs:
+            shutil.rmtree(working_dir, ignore_errors=True)
+
+    def release_workdir(self, working_dir):
+        """Empty the CSPP working directory and make it available for the next run."""
+        LOG.info("Cleaning up directory %s", working_dir)
+        cleanup_cspp_workdir(working_dir, keep_workdir=True)
+        self.workdirs.put(working_dir)
+
+
+class _LogRecordForwarder(logging.Handler):
+    """Hand the log records from the worker processes to the loggers of this process."""
+
+    def emit(self, record):
+        """Let the logger of the record handle it, as if it was logged in this process."""
+        logging.getLogger(record.name).handle(record)
+
+
+def _init_worker_logging(log_queue, level):
+    """Send all log records of a worker process to the *log_queue*, from the given *level*."""
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+
+
+def uri_to_path(uri):
+    """Get the file path from the *uri*, only parsing it when it is not a plain or local file path."""
+    if uri.startswith('/'):
+        return uri
+    if uri.startswith('file:///'):
+        return uri[len('file://'):]
+    return urlparse(uri).path
+
+
+def make_cspp_workdir(prefix=None):
+    """Create a working directory for CSPP under the CSPP Active Fires workdir."""
+    try:
+        return tempfile.mkdtemp(prefix=prefix, dir=CSPP_AF_WORKDIR)
+    except OSError:
+        return tempfile.mkdtemp(prefix=prefix)
+
+
+def get_cspp_base_cmdlist(options):
+    """Get the part of the CSPP command line that is the same for all runs."""
+    return (options['viirs_af_call'], '-d', '--num-cpu', '%d' % int(options.get('num_of_cpus', 4)))
+
+
+def spawn_cspp(sdrfiles, service, base_cmdlist, working_dir):
+    """Spawn a CSPP AF run on the set of SDR files given."""
+    LOG.info("Start CSPP: SDR files = %s", sdrfiles)
+    returncode = run_cspp_viirs_af(sdrfiles, service, base_cmdlist, working_dir)
+    if returncode != 0:
+        LOG.error("CSPP SDR Active Fires processing failed with exit code %d", returncode)
+        return working_dir, []
+    LOG.info("CSPP SDR Active Fires processing finished...")
+
+    result_files = get_active_fire_result_files(working_dir)
+    if LOG.isEnabledFor(logging.INFO):
+        LOG.info("Active Fires results - file names: %s", [f.rpartition(os.sep)[2] for f in result_files])
+    if len(result_files) == 0:
+        LOG.warning("No files available. CSPP probably failed!")
+        return working_dir, []
+
+    LOG.info("Number of results files = %s", len(result_files))
+    return working_dir, result_files
+
+
+def publish_af(publisher, edr_files, mda, **kwargs):
+    """Publish the messages that VIIRS AF EDR files are ready."""
+    if not edr_files:
+        return
+
+    # Now publish:
+    to_send = mda.copy()
+    # Delete the SDR dataset from the message:
+    try:
+        del (to_send['dataset'])
+    except KeyError:
+        LOG.warning("Couldn't remove dataset from message")
+
+    if 'orbit' in kwargs:
+        to_send["orig_orbit_number"] = to_send["orbit_number"]
+        to_send["orbit_number"] = kwargs['orbit']
+
+    publish_topic = kwargs.get('publish_topic', 'Unknown')
+    site = kwargs.get('site', 'unknown')
+    environment = kwargs.get('environment', 'unknown')
+
+    to_send['data_processing_level'] = '2'
+    to_send['format'] = 'edr'
+
+    for viirs_edr in edr_files:
+        to_send['uri'] = viirs_edr
+        filename = os.path.basename(viirs_edr)
+        to_send['uid'] = filename
+        if filename.endswith('nc'):
+            to_send['type'] = 'netcdf'
+        elif filename.endswith('txt'):
+            to_send['type'] = 'txt'
+        else:
+            LOG.error("File type unknown! Don't publish. Filename = %s", filename)
+            return
+
+        to_send['start_time'], to_send['end_time'] = get_edr_times(filename)
+
+        LOG.debug('Site = %s', site)
+        LOG.debug('Publish topic = %s', publish_topic)
+        for topic in publish_topic:
+            msg = Message('/'.join(('',
+                                    topic,
+                                    to_send['format'],
+                                    to_send['data_processing_level'],
+                                    site,
+                                    environment,
+                                    'polar',
+                                    'direct_readout')),
+                          "file", to_send).encode()
+
+            LOG.debug("sending: %s", msg)
+            publisher.send(msg)
+
+
+def receive_message(subscr, timeout):
+    """Receive one message from the *subscr*, or None if nothing arrived within *timeout* seconds."""
+    messages = subscr.recv(timeout=timeout)
+    try:
+        return next(messages)
+    finally:
+        messages.close()
+
+
+def viirs_active_fire_runner(options, service_name):
+    """Start the live runner for the CSPP VIIRS AF product generation."""
+    LOG.info("Start the VIIRS active fire runner...")
+    LOG.debug("Listens for messages of type: %s", options['message_types'])
+
+    ncpus_available = cpu_count()
+    LOG.info("Number of CPUs available = %s", ncpus_available)
+    ncpus = int(options.get('ncpus', 1))
+    LOG.info("Will use %d CPUs when running the CSPP VIIRS Active Fires instances", ncpus)
+    viirs_af_proc = ViirsActiveFiresProcessor(ncpus, options)
+
+    try:
+        with posttroll.subscriber.Subscribe('', options['message_types'], True) as subscr:
+            with Publish('viirs_active_fire_runner', 0) as publisher:
+
+                while True:
+                    viirs_af_proc.initialise(service_name)
+                    while True:
+                        msg = receive_message(subscr, viirs_af_proc.recv_timeout)
+                        status = viirs_af_proc.run(msg)
+                        if not status:
+                            break  # end the loop and reinitialize !
+
+                    # Also take in the burst of messages already waiting, so their CSPP runs go in parallel.
+                    # Check the cap before receiving, so no message is taken off the bus and then dropped
+                    while viirs_af_proc.cspp_results.qsize() < viirs_af_proc.max_inflight:
+                        msg = receive_message(subscr, BURST_TIMEOUT)
+                        if msg is None:
+                            break
+                        viirs_af_proc.run(msg)
+
+                    LOG.debug("Received message data = %s", viirs_af_proc.message_data)
+
+                    LOG.info("Get the results from the multiprocessing pool-run")
+                    # Deliver and publish each CSPP run as soon as it has finished
+                    futures = viirs_af_proc.get_cspp_futures()
+                    for res in as_completed(futures):
+                        working_dir, tmp_result_files = res.result()
+                        viirs_af_proc.result_files = tmp_result_files
+                        af_files = viirs_af_proc.deliver_output_files()
+                        viirs_af_proc.release_workdir(working_dir)
+                        publish_af(publisher, af_files,
+                                   futures[res],
+                                   orbit=viirs_af_proc.orbit_number,
+                                   publish_topic=viirs_af_proc.publish_topic,
+                                   environment=viirs_af_proc.environment,
+                                   site=viirs_af_proc.site)
+
+                    LOG.info("Active Fires EDR processing has completed.")
+    finally:
+        viirs_af_proc.shutdown()
+
+    return
+
+
+def _decode_line(line):
+    """Decode a line (or lines) of process output to text, without the surrounding whitespace."""
+    return line.strip().decode('utf-8', 'replace')
+
+
+def _log_process_output(proc, chunk_size=65536):
+    """Log the stdout and stderr lines of *proc* as they arrive, until both pipes are closed.
+
+    Both pipes are drained concurrently, so the process never blocks on a full pipe.
+    """
+    pipes = {}
+    residuals = {}
+    selector = selectors.DefaultSelector()
+    for pipe in (proc.stdout, proc.stderr):
+        fd = pipe.fileno()
+        os.set_blocking(fd, False)
+        selector.register(fd, selectors.EVENT_READ)
+        pipes[fd] = pipe
+        residuals[fd] = b''
+
+    while selector.get_map():
+        # Sleep in the kernel (epoll on Linux) until one of the pipes has data or is closed
+        for key, _ in selector.select():
+            try:
+                chunk = os.read(key.fd, chunk_size)
+            except BlockingIOError:
+                continue
+            if not chunk:
+                if residuals[key.fd]:
+                    LOG.debug(_decode_line(residuals[key.fd]))
+                selector.unregister(key.fd)
+                pipes[key.fd].close()
+                continue
+            lines = (residuals[key.fd] + chunk).split(b'\n')
+            residuals[key.fd] = lines.pop()
+            for line in lines:
+                LOG.debug(_decode_line(line))
+
+    selector.close()
+
+
+def run_cspp_viirs_af(viirs_sdr_files, service, base_cmdlist, working_dir):
+    """Run the CSPP VIIRS AF algorithm.
+
+    A wrapper for the CSPP VIIRS Active Fire algorithm. Return the exit code of CSPP.
+    """
+    cmdlist = list(base_cmdlist)
+    cmdlist.extend(['-W', working_dir])
+    if service == 'viirs-mbands':
+        cmdlist.extend(['-M'])
+        LOG.info("M-bands: %s", service)
+    elif service == 'viirs-ibands':
+        # I-bands:
+        LOG.info("I-bands %s", service)
+    else:
+        LOG.warning("Service not recognized: %s - Assume I-bands", service)
+
+    cmdlist.extend(viirs_sdr_files)
+
+    t0_wall = ptimer()
+    t0_times = os.times()
+    if LOG.isEnabledFor(logging.INFO):
+        LOG.info("Popen call arguments: %s", shlex.join(cmdlist))
+
+    if LOG.isEnabledFor(logging.DEBUG):
+        viirs_af_proc = Popen(cmdlist,
+                              cwd=working_dir,
+                              shell=False,
+                              stderr=PIPE, stdout=PIPE)
+        _log_process_output(viirs_af_proc)
+        returncode = viirs_af_proc.wait()
+    else:
+        # The CSPP output lines would not be logged anyway, so only keep stderr for failures
+        viirs_af_proc = run(cmdlist, cwd=working_dir, shell=False,
+                            stderr=PIPE, stdout=DEVNULL, check=False)
+        returncode = viirs_af_proc.returncode
+        if returncode != 0:
+            LOG.error("CSPP error output:\n%s", _decode_line(viirs_af_proc.stderr))
+
+    LOG.info("CSPP exit code: %d", returncode)
+
+    t1_times = os.times()
+    LOG.info("Seconds wall clock time: %.3f", ptimer() - t0_wall)
+    LOG.info("Seconds CSPP CPU time: %.3f",
+             (t1_times.children_user + t1_times.children_system) -
+             (t0_times.children_user + t0_times.children_system))
+
+    return returncode
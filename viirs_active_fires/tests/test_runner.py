@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Pytroll
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing the CSPP VIIRS Active Fire runner.
+"""
+
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import pytest
+from posttroll.message import Message
+
+from viirs_active_fires.runner import (ViirsActiveFiresProcessor, uri_to_path, get_cspp_base_cmdlist,
+                                       run_cspp_viirs_af, spawn_cspp, viirs_active_fire_runner)
+
+TEST_OPTIONS = {'viirs_af_call': 'cspp_active_fire_noaa.sh', 'num_of_cpus': 2,
+                'output_dir': '/tmp', 'publish_topic': ['VIIRS/L2/AFI']}
+
+CSPP_DUMMY_SCRIPT = """
+import sys
+print('Some CSPP output')
+sys.stderr.write('Some CSPP error output\\n' * 10000)
+print('Last CSPP output', end='')
+sys.exit(3)
+"""
+
+
+@pytest.mark.parametrize("uri,expected",
+                         [('/data/sdr/SVI01_npp.h5', '/data/sdr/SVI01_npp.h5'),
+                          ('file:///data/sdr/SVI01_npp.h5', '/data/sdr/SVI01_npp.h5'),
+                          ('ssh://myhost/data/sdr/SVI01_npp.h5', '/data/sdr/SVI01_npp.h5')])
+def test_uri_to_path(uri, expected):
+    """Test getting the file path from the uri."""
+    assert uri_to_path(uri) == expected
+
+
+def test_get_cspp_base_cmdlist():
+    """Test getting the fixed part of the CSPP command line."""
+    options = {'viirs_af_call': 'cspp_active_fire_noaa.sh', 'num_of_cpus': 2}
+
+    assert get_cspp_base_cmdlist(options) == ('cspp_active_fire_noaa.sh', '-d', '--num-cpu', '2')
+
+
+def test_processor_workdirs(tmp_path, monkeypatch):
+    """Test the working directories are created up front, and removed at shutdown."""
+    monkeypatch.setattr('viirs_active_fires.runner.CSPP_AF_WORKDIR', str(tmp_path))
+
+    viirs_af_proc = ViirsActiveFiresProcessor(2, TEST_OPTIONS)
+    assert len(os.listdir(tmp_path)) == 4
+    working_dir = viirs_af_proc.workdirs.get()
+    assert os.path.dirname(working_dir) == str(tmp_path)
+
+    viirs_af_proc.shutdown()
+    assert os.listdir(tmp_path) == []
+
+
+def test_run_cspp_viirs_af(tmp_path, caplog):
+    """Test running CSPP, logging its output and returning the exit code."""
+    base_cmdlist = (sys.executable, '-c', CSPP_DUMMY_SCRIPT)
+
+    with caplog.at_level(logging.DEBUG):
+        returncode = run_cspp_viirs_af(['SVI01_npp.h5'], 'viirs-ibands', base_cmdlist, str(tmp_path))
+
+    assert returncode == 3
+    assert caplog.messages.count('Some CSPP error output') == 10000
+    assert 'Some CSPP output' in caplog.messages
+    assert 'Last CSPP output' in caplog.messages
+
+
+def test_run_cspp_viirs_af_not_verbose(tmp_path, caplog):
+    """Test running CSPP without debug logging, only logging the error output on failure."""
+    base_cmdlist = (sys.executable, '-c', CSPP_DUMMY_SCRIPT)
+
+    with caplog.at_level(logging.INFO):
+        returncode = run_cspp_viirs_af(['SVI01_npp.h5'], 'viirs-ibands', base_cmdlist, str(tmp_path))
+
+    assert returncode == 3
+    assert 'Some CSPP output' not in caplog.messages
+    error_records = [record for record in caplog.records if record.levelno == logging.ERROR]
+    assert len(error_records) == 1
+    assert error_records[0].getMessage().count('Some CSPP error output') == 10000
+
+
+def test_processor_worker_logging(tmp_path, monkeypatch, caplog):
+    """Test the log records of the CSPP runs in the worker processes reach the logging of the runner."""
+    monkeypatch.setattr('viirs_active_fires.runner.CSPP_AF_WORKDIR', str(tmp_path))
+    base_cmdlist = (sys.executable, '-c', CSPP_DUMMY_SCRIPT)
+
+    with caplog.at_level(logging.DEBUG):
+        viirs_af_proc = ViirsActiveFiresProcessor(1, TEST_OPTIONS)
+        try:
+            future = viirs_af_proc.pool.submit(spawn_cspp, ['SVI01_npp.h5'], 'viirs-ibands',
+                                               base_cmdlist, str(tmp_path))
+            assert future.result() == (str(tmp_path), [])
+        finally:
+            viirs_af_proc.shutdown()
+
+    assert 'Some CSPP output' in caplog.messages
+    assert caplog.messages.count('Some CSPP error output') == 10000
+
+
+EDR_FILENAME = "AFIMG_npp_d20210413_t0916186_e0917428_b49018_c20210413092919781783_{granules}.txt"
+
+
+class FakePool:
+    """A stand-in for the CSPP worker pool, finishing every CSPP run right away."""
+
+    def __init__(self, *args, **kwargs):
+        """Initialize the fake pool."""
+        self.submitted = []
+
+    def submit(self, func, sdrfiles, service, base_cmdlist, working_dir):
+        """Record the submitted SDR files, and return a future with a result file named after the granules."""
+        self.submitted.append(sdrfiles)
+        granules = '-'.join(os.path.basename(sdrfile)[len('SVI01_'):-len('.h5')] for sdrfile in sdrfiles)
+        future = Future()
+        future.set_result((working_dir, [os.path.join(working_dir, EDR_FILENAME.format(granules=granules))]))
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        """Shut down the fake pool."""
+
+
+def make_sdr_message(granule, platform_name='Suomi-NPP', orbit_number=1, msg_type='dataset'):
+    """Make a posttroll message on one SDR granule."""
+    data = {'platform_name': platform_name, 'sensor': 'viirs', 'orbit_number': orbit_number,
+            'dataset': [{'uri': 'file:///data/sdr/SVI01_%s.h5' % granule, 'uid': 'SVI01_%s.h5' % granule}]}
+    return Message('/segment/SDR/1B', msg_type, data)
+
+
+@pytest.fixture
+def processor(tmp_path, monkeypatch):
+    """Get a VIIRS Active Fires processor with a fake worker pool."""
+    monkeypatch.setattr('viirs_active_fires.runner.CSPP_AF_WORKDIR', str(tmp_path))
+    monkeypatch.setattr('viirs_active_fires.runner.ProcessPoolExecutor', FakePool)
+    viirs_af_proc = ViirsActiveFiresProcessor(2, TEST_OPTIONS)
+    viirs_af_proc.initialise('viirs-ibands')
+    yield viirs_af_proc
+    viirs_af_proc.shutdown()
+
+
+def test_run_no_batch_window(processor):
+    """Test every dataset message gets its own CSPP run by default."""
+    assert processor.recv_timeout is None
+
+    assert processor.run(make_sdr_message('g1')) is False
+    assert processor.run(make_sdr_message('g2')) is False
+
+    assert processor.pool.submitted == [['/data/sdr/SVI01_g1.h5'], ['/data/sdr/SVI01_g2.h5']]
+    assert processor.recv_timeout is None
+
+
+def test_run_skips_other_messages(processor):
+    """Test messages that are not VIIRS datasets are skipped."""
+    assert processor.run(make_sdr_message('g1', platform_name='Metop-B')) is True
+    assert processor.run(make_sdr_message('g2', msg_type='file')) is True
+    assert processor.run(None) is True
+
+    assert processor.pool.submitted == []
+
+
+def test_run_batch_window(processor):
+    """Test the SDR files within the batch window go in one CSPP run, submitted on timeout."""
+    processor.batch_window = 0.2
+
+    assert processor.run(make_sdr_message('g1')) is True
+    assert 0 < processor.recv_timeout <= 0.2
+    assert processor.run(make_sdr_message('g2')) is True
+    assert processor.run(None) is True
+    assert processor.pool.submitted == []
+
+    time.sleep(0.25)
+    assert processor.recv_timeout == pytest.approx(0.001)
+    assert processor.run(None) is False
+
+    assert processor.pool.submitted == [['/data/sdr/SVI01_g1.h5', '/data/sdr/SVI01_g2.h5']]
+    assert processor.recv_timeout is None
+
+
+def test_run_batch_window_flushed_by_skipped_message(processor):
+    """Test a due batch is submitted also when the next message is skipped."""
+    processor.batch_window = 0.1
+
+    assert processor.run(make_sdr_message('g1')) is True
+    time.sleep(0.15)
+    assert processor.run(make_sdr_message('g2', platform_name='Metop-B')) is False
+
+    assert processor.pool.submitted == [['/data/sdr/SVI01_g1.h5']]
+
+
+def test_run_batch_split_on_platform_and_orbit(processor):
+    """Test granules from another platform or orbit are not merged into the pending batch."""
+    processor.batch_window = 10
+
+    msgs = [make_sdr_message('g1'), make_sdr_message('g2'),
+            make_sdr_message('g3', platform_name='NOAA-20'),
+            make_sdr_message('g4', platform_name='NOAA-20', orbit_number=2)]
+    assert [processor.run(msg) for msg in msgs] == [True, True, False, False]
+
+    futures = processor.get_cspp_futures()
+    assert processor.pool.submitted == [['/data/sdr/SVI01_g1.h5', '/data/sdr/SVI01_g2.h5'],
+                                        ['/data/sdr/SVI01_g3.h5']]
+    batch_keys = [(mda['platform_name'], mda['orbit_number']) for mda in futures.values()]
+    assert batch_keys == [('Suomi-NPP', 1), ('NOAA-20', 1)]
+
+
+class StopRunner(Exception):
+    """Stop the runner loop when all the test messages have been handled."""
+
+
+class FakeSubscriber:
+    """A stand-in for the posttroll subscriber, handing out the given messages."""
+
+    def __init__(self, messages):
+        """Initialize the fake subscriber."""
+        self.messages = deque(messages)
+
+    def recv(self, timeout=None):
+        """Yield the messages, then None on timeouts, or stop the runner when it would wait forever."""
+        while True:
+            if self.messages:
+                yield self.messages.popleft()
+            elif timeout is None:
+                raise StopRunner()
+            else:
+                yield None
+
+
+class FakePublisher:
+    """A stand-in for the posttroll publisher, keeping the sent messages."""
+
+    def __init__(self):
+        """Initialize the fake publisher."""
+        self.sent = []
+
+    def send(self, msg):
+        """Keep the sent message."""
+        self.sent.append(Message(rawstr=msg))
+
+
+def run_fake_runner(monkeypatch, tmp_path, messages, ncpus):
+    """Run the runner on the *messages* with fake posttroll and CSPP, and return the published messages."""
+    subscriber = FakeSubscriber(messages)
+    publisher = FakePublisher()
+
+    @contextmanager
+    def fake_subscribe(*args):
+        yield subscriber
+
+    @contextmanager
+    def fake_publish(*args):
+        yield publisher
+
+    monkeypatch.setattr('viirs_active_fires.runner.CSPP_AF_WORKDIR', str(tmp_path))
+    monkeypatch.setattr('viirs_active_fires.runner.ProcessPoolExecutor', FakePool)
+    monkeypatch.setattr('viirs_active_fires.runner.posttroll.subscriber.Subscribe', fake_subscribe)
+    monkeypatch.setattr('viirs_active_fires.runner.Publish', fake_publish)
+    monkeypatch.setattr('viirs_active_fires.runner.deliver_output_files', lambda files, *args: files)
+
+    options = dict(TEST_OPTIONS, ncpus=ncpus, message_types=['/segment/SDR/1B'], site='test', environment='test')
+    with pytest.raises(StopRunner):
+        viirs_active_fire_runner(options, 'viirs-ibands')
+
+    return publisher.sent
+
+
+def test_runner_burst_submits_every_message(monkeypatch, tmp_path):
+    """Test no message of a burst larger than the number of CSPP runs in flight is lost."""
+    messages = [make_sdr_message('g%d' % idx) for idx in range(6)]
+
+    sent = run_fake_runner(monkeypatch, tmp_path, messages, ncpus=1)
+
+    granules = sorted(msg.data['uid'].split('_')[-1][:-len('.txt')] for msg in sent)
+    assert granules == ['g0', 'g1', 'g2', 'g3', 'g4', 'g5']
+
+
+def test_runner_publishes_with_own_message_data(monkeypatch, tmp_path):
+    """Test each CSPP result is published with the metadata of its own message."""
+    messages = [make_sdr_message('g0', platform_name='NOAA-20', orbit_number=100),
+                make_sdr_message('g1', platform_name='Suomi-NPP', orbit_number=200),
+                make_sdr_message('g2', platform_name='NOAA-21', orbit_number=300)]
+
+    sent = run_fake_runner(monkeypatch, tmp_path, messages, ncpus=2)
+
+    published = sorted((msg.data['uid'].split('_')[-1][:-len('.txt')],
+                        msg.data['platform_name'], msg.data['orig_orbit_number']) for msg in sent)
+    assert published == [('g0', 'NOAA-20', 100), ('g1', 'Suomi-NPP', 200), ('g2', 'NOAA-21', 300)]
@@ -28,7 +28,8 @@ import pytest
 from datetime import datetime
 from unittest.mock import patch
 
-from viirs_active_fires.utils import get_edr_times
+from viirs_active_fires.utils import (get_edr_times, cleanup_cspp_workdir, deliver_output_files,
+                                      get_active_fire_result_files)
 
 TESTFILENAME = "AFIMG_npp_d20210413_t0916186_e0917428_b49018_c20210413092919781783_cspp_dev.txt"
 
@@ -43,3 +44,81 @@ def test_get_edr_times(basename):
     expected = (datetime(2021, 4, 13, 9, 16, 18), datetime(2021, 4, 13, 9, 17, 42))
     assert timetup[0] == expected[0]
     assert timetup[1] == expected[1]
+
+
+@pytest.mark.parametrize("fname,exp_start,exp_end",
+                         [(TESTFILENAME,
+                           datetime(2021, 4, 13, 9, 16, 18), datetime(2021, 4, 13, 9, 17, 42)),
+                          ("AFMOD_j01_d20211231_t2359559_e0001201_b21557_c20220101000512345678_cspp_dev.nc",
+                           datetime(2021, 12, 31, 23, 59, 55), datetime(2022, 1, 1, 0, 1, 20)),
+                          ("AFIMG_j02_d20240229_t2358301_e0000000_b06789_c20240301000412345678_cspp_dev.txt",
+                           datetime(2024, 2, 29, 23, 58, 30), datetime(2024, 3, 1, 0, 0, 0)),
+                          ("AFIMG_npp_d20230601_t0000000_e0001249_b60123_c20230601000812345678_cspp_dev.txt",
+                           datetime(2023, 6, 1, 0, 0, 0), datetime(2023, 6, 1, 0, 1, 24))])
+def test_get_edr_times_parametrized(fname, exp_start, exp_end):
+    """Test getting the start and end times from edr filenames, also across day, month and year boundaries."""
+    timetup = get_edr_times(os.path.join('/path/to', fname))
+
+    assert timetup == (exp_start, exp_end)
+
+
+def test_get_edr_times_no_times():
+    """Test getting the start and end times from a file name without times."""
+    with pytest.raises(ValueError):
+        get_edr_times('/path/to/AFIMG_npp_cspp_dev.txt')
+
+
+def test_cleanup_cspp_workdir(tmp_path):
+    """Test cleaning up the CSPP working directory."""
+    workdir = tmp_path / 'workdir'
+    (workdir / 'subdir').mkdir(parents=True)
+    (workdir / 'AFIMG_npp.txt').write_text('fires')
+    (workdir / 'subdir' / 'AFIMG_npp.nc').write_text('fires')
+
+    cleanup_cspp_workdir(str(workdir))
+
+    assert not workdir.exists()
+
+
+def test_cleanup_cspp_workdir_keep_workdir(tmp_path):
+    """Test emptying the CSPP working directory, keeping it for reuse."""
+    workdir = tmp_path / 'workdir'
+    (workdir / 'subdir').mkdir(parents=True)
+    (workdir / 'AFIMG_npp.txt').write_text('fires')
+    (workdir / '.hidden').write_text('fires')
+    (workdir / 'subdir' / 'AFIMG_npp.nc').write_text('fires')
+
+    cleanup_cspp_workdir(str(workdir), keep_workdir=True)
+
+    assert workdir.is_dir()
+    assert os.listdir(workdir) == []
+
+
+def test_deliver_output_files(tmp_path):
+    """Test delivering the output files to the sub directory."""
+    workdir = tmp_path / 'workdir'
+    workdir.mkdir()
+    affiles = []
+    for idx in range(6):
+        affile = workdir / ('AFIMG_npp_%d.txt' % idx)
+        affile.write_text('fires %d' % idx)
+        affiles.append(str(affile))
+
+    result = deliver_output_files(affiles, str(tmp_path / 'output'), subdir='ibands', max_workers=3)
+
+    expected = [os.path.join(str(tmp_path / 'output' / 'ibands'), os.path.basename(affile)) for affile in affiles]
+    assert result == expected
+    for idx, newfilename in enumerate(result):
+        with open(newfilename) as fpt:
+            assert fpt.read() == 'fires %d' % idx
+
+
+def test_get_active_fire_result_files(tmp_path):
+    """Test getting the Active Fire result files from the CSPP working directory."""
+    for name in ['AFIMG_npp.txt', 'AFMOD_npp.nc', 'AFIMG_npp.log', 'GMTCO_npp.h5', 'AFEDR.nc.tmp']:
+        (tmp_path / name).write_text('fires')
+    (tmp_path / 'AFDIR.nc').mkdir()
+
+    result = get_active_fire_result_files(str(tmp_path))
+
+    assert result == [str(tmp_path / 'AFIMG_npp.txt'), str(tmp_path / 'AFMOD_npp.nc')]
@@ -27,32 +27,25 @@
 
 import logging
 import os
-from glob import glob
-import netifaces
-import six
-import time
+import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import shutil
 import stat
 
-if six.PY2:
-    from urlparse import urlparse
-    from urlparse import urlunsplit
-elif six.PY3:
-    from urllib.parse import urlparse
-    from urllib.parse import urlunsplit
-
-if six.PY2:
-    ptimer = time.clock
-elif six.PY3:
-    ptimer = time.perf_counter
-
 LOG = logging.getLogger(__name__)
 
+#: Date, start and end time (with tenths of seconds) in the EDR file names
+_EDR_TIMES_PATTERN = re.compile(r'_d(\d{8})_t(\d{7})_e(\d{7})_')
+
 
-def deliver_output_files(affiles, base_dir, subdir=None):
+def deliver_output_files(affiles, base_dir, subdir=None, max_workers=4):
     """Copy the Active Fire output files to the sub-directory under the *subdir* directory
-    structure"""
+    structure
+
+    The files are copied in parallel by up to *max_workers* threads, as the copying is
+    bound by the latency of the (often networked) destination file system.
+    """
 
     LOG.debug("base_dir: %s", base_dir)
 
@@ -61,7 +54,7 @@ def deliver_output_files(affiles, base_dir, subdir=None):
     else:
         path = base_dir
 
-    LOG.debug("Path: %s", str(path))
+    LOG.debug("Path: %s", path)
 
     if not os.path.exists(path):
         LOG.warning("Directory does not exist - create it: %s", path)
@@ -69,33 +62,52 @@ def deliver_output_files(affiles, base_dir, subdir=None):
     else:
         LOG.debug("Directory exists: %s", path)
 
-    LOG.info("Number of Active Fire result files: " + str(len(affiles)))
-    retvl = []
-    for affile in affiles:
-        newfilename = os.path.join(path, os.path.basename(affile))
-        LOG.info("Copy affile to destination: " + newfilename)
-        if os.path.exists(affile):
-            LOG.info("File to copy: {file} <> ST_MTIME={time}".format(file=str(affile),
-                                                                      time=datetime.utcfromtimestamp(os.stat(affile)[stat.ST_MTIME]).strftime('%Y%m%d-%H%M%S')))
-        shutil.copy(affile, newfilename)
-        if os.path.exists(newfilename):
-            LOG.info("File at destination: {file} <> ST_MTIME={time}".format(file=str(newfilename),
-                                                                             time=datetime.utcfromtimestamp(os.stat(newfilename)[stat.ST_MTIME]).strftime('%Y%m%d-%H%M%S')))
-
-        retvl.append(newfilename)
-
-    return retvl
-
-
-def cleanup_cspp_workdir(workdir):
-    """Clean up the CSPP working dir after processing"""
-
-    filelist = glob('%s/*' % workdir)
-    dummy = [os.remove(s) for s in filelist if os.path.isfile(s)]
-    filelist = glob('%s/*' % workdir)
-    LOG.info(
-        "Number of items left after cleaning working dir = " + str(len(filelist)))
-    shutil.rmtree(workdir)
+    LOG.info("Number of Active Fire result files: %s", len(affiles))
+    if not affiles:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_copy_output_file, affiles, [path] * len(affiles)))
+
+
+def _copy_output_file(affile, path):
+    """Copy one Active Fire output file to the *path* directory."""
+    newfilename = os.path.join(path, os.path.basename(affile))
+    LOG.info("Copy affile to destination: %s", newfilename)
+    if os.path.exists(affile):
+        LOG.info("File to copy: %s <> ST_MTIME=%s", affile, _get_mtime_str(affile))
+    shutil.copy(affile, newfilename)
+    if os.path.exists(newfilename):
+        LOG.info("File at destination: %s <> ST_MTIME=%s", newfilename, _get_mtime_str(newfilename))
+
+    return newfilename
+
+
+def _get_mtime_str(filename):
+    """Get the modification time of the file as a string."""
+    return datetime.utcfromtimestamp(os.stat(filename)[stat.ST_MTIME]).strftime('%Y%m%d-%H%M%S')
+
+
+def cleanup_cspp_workdir(workdir, keep_workdir=False):
+    """Clean up the CSPP working dir after processing
+
+    If *keep_workdir* is True only the content is removed, so the directory can be reused.
+    """
+
+    subdirs = []
+    with os.scandir(workdir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            else:
+                os.remove(entry.path)
+    LOG.info("Number of items left after cleaning working dir = %s", len(subdirs))
+    if not keep_workdir:
+        shutil.rmtree(workdir)
+        return
+
+    for subdir in subdirs:
+        shutil.rmtree(subdir)
     return
 
 
@@ -103,12 +115,15 @@ def get_edr_times(filename):
     """Get the start and end times from the SDR file name
     """
     bname = os.path.basename(filename)
-    sll = bname.split('_')
-
-    start_time = datetime.strptime(sll[2] + sll[3][:-1],
-                                   "d%Y%m%dt%H%M%S")
-    end_time = datetime.strptime(sll[2] + sll[4][:-1],
-                                 "d%Y%m%de%H%M%S")
+    match = _EDR_TIMES_PATTERN.search(bname)
+    if match is None:
+        raise ValueError("No start and end times in file name: %s" % bname)
+    date, start, end = match.groups()
+
+    # The tenths of seconds are ignored
+    year, month, day = int(date[:4]), int(date[4:6]), int(date[6:8])
+    start_time = datetime(year, month, day, int(start[:2]), int(start[2:4]), int(start[4:6]))
+    end_time = datetime(year, month, day, int(end[:2]), int(end[2:4]), int(end[4:6]))
     if end_time < start_time:
         end_time += timedelta(days=1)
 
@@ -121,7 +136,8 @@ def get_active_fire_result_files(res_dir):
     work-dir for delivery
     """
 
-    result_files = (glob(os.path.join(res_dir, 'AF*.nc')) +
-                    glob(os.path.join(res_dir, 'AF*.txt')))
+    with os.scandir(res_dir) as entries:
+        result_files = [entry.path for entry in entries
+                        if entry.name.startswith('AF') and entry.name.endswith(('.nc', '.txt')) and entry.is_file()]
 
     return sorted(result_files)